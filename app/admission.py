@@ -0,0 +1,223 @@
+"""
+Admission control and load shedding for the API.
+
+Every request is classified into a lane before it reaches a route handler.
+Each lane has:
+ - a concurrency limit (requests allowed to run at once)
+ - a bounded wait queue (requests allowed to wait for a slot)
+ - a queue deadline (how long a request may wait before it is shed)
+
+When the queue is full, or a request waits past its deadline, it is rejected
+straight away with 503 + Retry-After instead of piling up on the threadpool
+and the DB connection pool.
+
+Lanes give us priority: cheap GET /users/{id} lookups have their own (larger)
+lane, so they keep flowing while unfiltered GET /users and bulk writes are
+throttled in a small lane of their own.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import time
+
+from fastapi import Request
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed by its lane."""
+
+    def __init__(self, lane: str, reason: str, retry_after: int):
+        super().__init__(f"lane '{lane}' overloaded ({reason})")
+        self.lane = lane
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+# ---------------------------------------------------
+# LANE (concurrency limit + bounded queue + deadline)
+# ---------------------------------------------------
+class Lane:
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, queue_timeout: float, retry_after: int):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+
+        self._slots = asyncio.Semaphore(max_concurrent)
+
+        # counters exported as metrics
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted_total = 0
+        self.shed_total = {"queue_full": 0, "deadline": 0}
+        self.wait_seconds_total = 0.0
+
+    def set_max_concurrent(self, max_concurrent: int):
+        # Only safe before the lane has admitted any request (startup)
+        self.max_concurrent = max_concurrent
+        self._slots = asyncio.Semaphore(max_concurrent)
+
+    def _shed(self, reason: str):
+        self.shed_total[reason] += 1
+        raise Overloaded(self.name, reason, self.retry_after)
+
+    async def acquire(self):
+        # Fast path: a slot is free, no queueing
+        if not self._slots.locked():
+            await self._slots.acquire()
+        else:
+            # Queue is full -> reject immediately, don't make the client wait
+            if self.queued >= self.max_queue:
+                self._shed("queue_full")
+
+            self.queued += 1
+            started = time.monotonic()
+            try:
+                await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._shed("deadline")
+            finally:
+                self.queued -= 1
+                self.wait_seconds_total += time.monotonic() - started
+
+        self.in_flight += 1
+        self.admitted_total += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._slots.release()
+
+
+# ---------------------------------------------------
+# LANE CONFIG (env overridable, like database.py)
+# ---------------------------------------------------
+# The sum of max_concurrent across lanes must stay within the SQLAlchemy pool
+# capacity (pool_size=5 + max_overflow=10 by default) so admitted requests
+# never wait on the pool itself. check_pool_capacity() enforces this at startup.
+def _lane_from_env(name: str, max_concurrent: int, max_queue: int, queue_timeout: float, retry_after: int) -> Lane:
+    prefix = f"ADMISSION_{name.upper()}_"
+    return Lane(
+        name=name,
+        max_concurrent=int(os.getenv(prefix + "CONCURRENCY", max_concurrent)),
+        max_queue=int(os.getenv(prefix + "QUEUE", max_queue)),
+        queue_timeout=float(os.getenv(prefix + "TIMEOUT", queue_timeout)),
+        retry_after=int(os.getenv(prefix + "RETRY_AFTER", retry_after)),
+    )
+
+
+LANES = {
+    "lookup": _lane_from_env("lookup", max_concurrent=8, max_queue=64, queue_timeout=2.0, retry_after=1),
+    "default": _lane_from_env("default", max_concurrent=4, max_queue=16, queue_timeout=5.0, retry_after=2),
+    "bulk": _lane_from_env("bulk", max_concurrent=2, max_queue=4, queue_timeout=10.0, retry_after=10),
+}
+
+# Lanes are clamped in this order when they don't fit in the pool
+CLAMP_ORDER = ("bulk", "default", "lookup")
+
+
+def check_pool_capacity(engine):
+    """Clamp lane concurrency so the lanes together fit in the DB pool."""
+    pool = engine.pool
+    if not hasattr(pool, "size"):
+        return  # pool without a fixed size (e.g. NullPool)
+    max_overflow = getattr(pool, "_max_overflow", 0)
+    if max_overflow < 0:
+        return  # max_overflow=-1 means unlimited overflow connections
+    capacity = pool.size() + max_overflow
+    total = sum(lane.max_concurrent for lane in LANES.values())
+    if total <= capacity:
+        return
+
+    logging.warning(
+        "Admission lanes allow %d concurrent requests but the DB pool only has %d connections; clamping lanes",
+        total, capacity,
+    )
+    excess = total - capacity
+    for name in CLAMP_ORDER:
+        lane = LANES[name]
+        cut = min(excess, lane.max_concurrent - 1)  # every lane keeps at least 1 slot
+        if cut > 0:
+            lane.set_max_concurrent(lane.max_concurrent - cut)
+            excess -= cut
+    if excess > 0:
+        logging.warning(
+            "Every admission lane is down to 1 slot; lanes still exceed the DB pool by %d connections",
+            excess,
+        )
+    for lane in LANES.values():
+        logging.warning("Admission lane %s: max_concurrent=%d", lane.name, lane.max_concurrent)
+
+
+# Paths that bypass admission control entirely
+EXEMPT_PATHS = {"/metrics", "/docs", "/redoc", "/openapi.json", "/docs/oauth2-redirect"}
+
+LOOKUP_PATH = re.compile(r"^/users/\d+$")
+USER_FILTERS = ("company", "bank", "pincode")
+
+
+# ---------------------------------------------------
+# CLASSIFY REQUEST -> LANE
+# ---------------------------------------------------
+def classify(request: Request) -> Lane | None:
+    path = request.url.path.rstrip("/") or "/"
+    method = request.method
+
+    if path in EXEMPT_PATHS:
+        return None
+
+    # Cheap primary-key lookup. /users/intersect stays in "default": with no
+    # filters it walks the whole bitmap index, which is CPU-bound.
+    if method == "GET" and LOOKUP_PATH.match(path):
+        return LANES["lookup"]
+
+    if path == "/users":
+        # Unfiltered list reads the whole users table (+ relationships)
+        if method == "GET" and not any(request.query_params.get(f) for f in USER_FILTERS):
+            return LANES["bulk"]
+        # Create user scans all users for the duplicate-email check
+        if method == "POST":
+            return LANES["bulk"]
+
+    return LANES["default"]
+
+
+# ---------------------------------------------------
+# METRICS (Prometheus text format)
+# ---------------------------------------------------
+def render_metrics() -> str:
+    lines = [
+        "# HELP admission_queue_depth Requests currently waiting for a slot.",
+        "# TYPE admission_queue_depth gauge",
+    ]
+    lines += [f'admission_queue_depth{{lane="{lane.name}"}} {lane.queued}' for lane in LANES.values()]
+
+    lines += [
+        "# HELP admission_in_flight Requests currently being handled.",
+        "# TYPE admission_in_flight gauge",
+    ]
+    lines += [f'admission_in_flight{{lane="{lane.name}"}} {lane.in_flight}' for lane in LANES.values()]
+
+    lines += [
+        "# HELP admission_admitted_total Requests admitted to run.",
+        "# TYPE admission_admitted_total counter",
+    ]
+    lines += [f'admission_admitted_total{{lane="{lane.name}"}} {lane.admitted_total}' for lane in LANES.values()]
+
+    lines += [
+        "# HELP admission_shed_total Requests rejected with 503.",
+        "# TYPE admission_shed_total counter",
+    ]
+    for lane in LANES.values():
+        for reason, count in lane.shed_total.items():
+            lines.append(f'admission_shed_total{{lane="{lane.name}",reason="{reason}"}} {count}')
+
+    lines += [
+        "# HELP admission_wait_seconds_total Total time requests spent queued.",
+        "# TYPE admission_wait_seconds_total counter",
+    ]
+    lines += [f'admission_wait_seconds_total{{lane="{lane.name}"}} {lane.wait_seconds_total:.6f}' for lane in LANES.values()]
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,415 @@
+"""
+User bitmap index: file format, encoder (used by etl/group_users.py) and the
+memory-mapped reader used by /users/intersect.
+
+The index holds one Roaring-style bitmap of user_ids per bank, company and
+pincode key. It is memory-mapped and only the containers a query touches are
+decoded, per query; nothing is cached, so resident memory stays proportional
+to the query, not the index.
+
+A decoded bitmap is a dict of high 16 bits -> container, where a container is
+either a sorted sequence of low 16 bits (sparse; a zero-copy view into the
+mmap when read from the file) or an int with one bit per low value (dense).
+AND / OR / NOT work container by container.
+
+Publishing: each ETL run writes user_bitmaps_<ts>.idx and then atomically
+replaces the small pointer file user_bitmaps.current with that filename. The
+API maps the timestamped file and never the pointer, so the ETL never has to
+replace a file that is mapped (not possible on Windows). The pointer is
+re-checked (os.stat) on every query; when it changes a new index is loaded and
+swapped in, in-flight queries finish on the old one, and the old one is closed
+once they are done. If a new index can't be loaded the previous one keeps
+serving.
+"""
+
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ---------------------------------------------------
+# FILE FORMAT (single source of truth for ETL + API)
+# ---------------------------------------------------
+# user_ids are split into chunks of 65536 by their high 16 bits; each chunk
+# is stored as either
+#   - an array container: sorted uint16 low bits (<= 4096 ids, 2 bytes/id)
+#   - a bitmap container: 8192 bytes, bit n set == low bits n present
+# so a sparse key costs ~2 bytes per user no matter how spread its ids are.
+#
+# File:
+#   BITMAP_MAGIC
+#   HEADER_LEN (uint64) length of the JSON header
+#   header    {"created_at": ..., "all": [offset, nbytes, count],
+#              "dimensions": {"bank": {key: [offset, nbytes, count]}, ...}}
+#   blobs     one per bitmap, offsets relative to the start of the blob section
+# Blob:
+#   uint32 n_containers
+#   n x CONTAINER_ENTRY (uint32 high, uint8 kind, uint32 cardinality)
+#   container data in the same order
+# All integers are little-endian.
+BITMAP_MAGIC = b"UBMIDX02"
+HEADER_LEN = struct.Struct("<Q")
+CONTAINER_COUNT = struct.Struct("<I")
+CONTAINER_ENTRY = struct.Struct("<IBI")
+ARRAY, BITMAP = 0, 1
+ARRAY_MAX = 4096
+BITMAP_BYTES = (1 << 16) // 8
+
+POINTER_FILENAME = "user_bitmaps.current"
+
+# Default matches the ETL's default output dir (etl/output/ in the repo),
+# independent of the directory the API is started from.
+DEFAULT_INDEX_DIR = Path(__file__).resolve().parents[1] / "etl" / "output"
+BITMAP_INDEX_DIR = os.getenv("BITMAP_INDEX_DIR", str(DEFAULT_INDEX_DIR))
+
+DIMENSIONS = ("bank", "company", "pincode")
+
+_NONZERO_BYTE = re.compile(rb"[^\x00]")
+
+
+class IndexUnavailable(Exception):
+    """Raised when the bitmap index file is missing or unreadable."""
+
+
+def encode_bitmap(user_ids) -> bytes:
+    """Encode user_ids as one blob in the format above."""
+    chunks = {}
+    for uid in {int(i) for i in user_ids}:
+        chunks.setdefault(uid >> 16, []).append(uid & 0xFFFF)
+
+    directory = [CONTAINER_COUNT.pack(len(chunks))]
+    data = []
+    for high in sorted(chunks):
+        lows = sorted(chunks[high])
+        if len(lows) <= ARRAY_MAX:
+            directory.append(CONTAINER_ENTRY.pack(high, ARRAY, len(lows)))
+            data.append(struct.pack(f"<{len(lows)}H", *lows))
+        else:
+            buf = bytearray(BITMAP_BYTES)
+            for low in lows:
+                buf[low >> 3] |= 1 << (low & 7)
+            directory.append(CONTAINER_ENTRY.pack(high, BITMAP, len(lows)))
+            data.append(bytes(buf))
+    return b"".join(directory + data)
+
+
+# ---------------------------------------------------
+# CONTAINER OPS (sequence = sorted lows, int = dense bitmap)
+# ---------------------------------------------------
+def _contains(lows, low) -> bool:
+    i = bisect_left(lows, low)
+    return i < len(lows) and lows[i] == low
+
+
+def _array_to_int(lows) -> int:
+    buf = bytearray(BITMAP_BYTES)
+    for low in lows:
+        buf[low >> 3] |= 1 << (low & 7)
+    return int.from_bytes(buf, "little")
+
+
+def _filter_by_bits(lows, bits: int, keep: bool) -> tuple:
+    data = bits.to_bytes(BITMAP_BYTES, "little")
+    return tuple(low for low in lows if bool(data[low >> 3] >> (low & 7) & 1) == keep)
+
+
+def _and(a, b):
+    if isinstance(a, int) and isinstance(b, int):
+        return a & b
+    if isinstance(a, int):
+        a, b = b, a
+    if isinstance(b, int):
+        return _filter_by_bits(a, b, keep=True)
+    # Walk the smaller array, binary-search the larger one
+    if len(a) > len(b):
+        a, b = b, a
+    return tuple(low for low in a if _contains(b, low))
+
+
+def _or(a, b):
+    if not isinstance(a, int) and not isinstance(b, int):
+        merged = set(a).union(b)
+        if len(merged) <= ARRAY_MAX:
+            return tuple(sorted(merged))
+        return _array_to_int(merged)
+    if not isinstance(a, int):
+        a = _array_to_int(a)
+    if not isinstance(b, int):
+        b = _array_to_int(b)
+    return a | b
+
+
+def _andnot(a, b):
+    if not isinstance(a, int):
+        if isinstance(b, int):
+            return _filter_by_bits(a, b, keep=False)
+        return tuple(low for low in a if not _contains(b, low))
+    if not isinstance(b, int):
+        b = _array_to_int(b)
+    return a & ~b
+
+
+def _cardinality(container) -> int:
+    return container.bit_count() if isinstance(container, int) else len(container)
+
+
+def and_bitmaps(a: dict, b: dict) -> dict:
+    result = {}
+    for high in a.keys() & b.keys():
+        container = _and(a[high], b[high])
+        if container:
+            result[high] = container
+    return result
+
+
+def or_bitmaps(a: dict, b: dict) -> dict:
+    result = dict(a)
+    for high, container in b.items():
+        result[high] = _or(result[high], container) if high in result else container
+    return result
+
+
+def andnot_bitmaps(a: dict, b: dict) -> dict:
+    result = {}
+    for high, container in a.items():
+        if high in b:
+            container = _andnot(container, b[high])
+        if container:
+            result[high] = container
+    return result
+
+
+# ---------------------------------------------------
+# INDEX (one mmap'd file)
+# ---------------------------------------------------
+class BitmapIndex:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            if self._mm[:len(BITMAP_MAGIC)] != BITMAP_MAGIC:
+                raise IndexUnavailable(f"{path} is not a bitmap index")
+
+            header_start = len(BITMAP_MAGIC) + HEADER_LEN.size
+            (header_len,) = HEADER_LEN.unpack_from(self._mm, len(BITMAP_MAGIC))
+            header = json.loads(self._mm[header_start:header_start + header_len])
+
+            self._blob_start = header_start + header_len
+            self.created_at = header["created_at"]
+            self._all = header["all"]
+            self._dimensions = header["dimensions"]
+        except Exception:
+            self._mm.close()
+            raise
+
+        self._view = memoryview(self._mm)
+        # in-flight queries; a retired index is closed when this drops to 0
+        self._users = 0
+        self._retired = False
+
+    def close(self):
+        try:
+            self._view.release()
+            self._mm.close()
+        except BufferError:
+            # A query result still holds a view into the map; the mapping is
+            # released when that last view is garbage collected.
+            pass
+
+    def _decode(self, entry) -> dict:
+        """Decode one blob from the mmap into {high: container}."""
+        offset, _nbytes, _count = entry
+        pos = self._blob_start + offset
+        (n_containers,) = CONTAINER_COUNT.unpack_from(self._mm, pos)
+        pos += CONTAINER_COUNT.size
+        data_pos = pos + n_containers * CONTAINER_ENTRY.size
+
+        result = {}
+        for _ in range(n_containers):
+            high, kind, cardinality = CONTAINER_ENTRY.unpack_from(self._mm, pos)
+            pos += CONTAINER_ENTRY.size
+            if kind == ARRAY:
+                result[high] = self._array(data_pos, cardinality)
+                data_pos += cardinality * 2
+            else:
+                result[high] = int.from_bytes(self._mm[data_pos:data_pos + BITMAP_BYTES], "little")
+                data_pos += BITMAP_BYTES
+        return result
+
+    def _array(self, pos: int, cardinality: int):
+        if sys.byteorder == "little":
+            # zero-copy view into the mmap
+            return self._view[pos:pos + cardinality * 2].cast("H")
+        return struct.unpack_from(f"<{cardinality}H", self._mm, pos)
+
+    def all_users(self) -> dict:
+        return self._decode(self._all)
+
+    def bitmap(self, dimension: str, key: str) -> dict:
+        """Bitmap for one key; unknown keys give an empty bitmap."""
+        entry = self._dimensions.get(dimension, {}).get(key)
+        return self._decode(entry) if entry else {}
+
+    def any_of(self, dimension: str, keys) -> dict:
+        """OR of the bitmaps for the given keys."""
+        result = {}
+        for key in keys:
+            result = or_bitmaps(result, self.bitmap(dimension, key))
+        return result
+
+    def query(self, include: dict, exclude: dict | None = None) -> dict:
+        """
+        include: dimension -> list of keys. Keys are ORed within a dimension,
+                 dimensions are ANDed together. Empty include means all users.
+        exclude: dimension -> list of keys; matching users are removed (NOT).
+        """
+        result = None
+        for dimension, keys in include.items():
+            if keys:
+                matched = self.any_of(dimension, keys)
+                result = matched if result is None else and_bitmaps(result, matched)
+        if result is None:
+            result = self.all_users()
+        for dimension, keys in (exclude or {}).items():
+            if keys and result:
+                result = andnot_bitmaps(result, self.any_of(dimension, keys))
+        return result
+
+
+# ---------------------------------------------------
+# HELPERS
+# ---------------------------------------------------
+def count(bitmap: dict) -> int:
+    return sum(_cardinality(container) for container in bitmap.values())
+
+
+def to_ids(bitmap: dict, limit: int | None = None) -> list[int]:
+    """Sorted user_ids set in the bitmap (at most `limit` of them)."""
+    ids = []
+    for high in sorted(bitmap):
+        base = high << 16
+        container = bitmap[high]
+        if isinstance(container, int):
+            data = container.to_bytes(BITMAP_BYTES, "little")
+            # regex skips runs of zero bytes in C
+            lows = (
+                match.start() * 8 + bit
+                for match in _NONZERO_BYTE.finditer(data)
+                for bit in range(8)
+                if data[match.start()] >> bit & 1
+            )
+        else:
+            lows = container
+        for low in lows:
+            if limit is not None and len(ids) >= limit:
+                return ids
+            ids.append(base + low)
+    return ids
+
+
+# ---------------------------------------------------
+# CURRENT INDEX (reloaded atomically when ETL lands)
+# ---------------------------------------------------
+_lock = threading.Lock()
+_current = None
+_current_stat = None
+_failed_stat = None
+
+
+def _pointer_stat_key(pointer_path: str):
+    try:
+        st = os.stat(pointer_path)
+    except OSError as exc:
+        raise IndexUnavailable(f"Bitmap index not found at {pointer_path}; run the ETL first") from exc
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _load(index_dir: str) -> BitmapIndex:
+    """Follow the pointer file and map the index it names."""
+    try:
+        with open(os.path.join(index_dir, POINTER_FILENAME)) as f:
+            filename = os.path.basename(f.read().strip())
+        return BitmapIndex(os.path.join(index_dir, filename))
+    except IndexUnavailable:
+        raise
+    except (OSError, ValueError, KeyError, TypeError, struct.error) as exc:
+        # PermissionError, empty file (mmap ValueError), corrupt/truncated header
+        raise IndexUnavailable(f"Bitmap index in {index_dir} is unreadable: {exc}") from exc
+
+
+def _retire(index: BitmapIndex):
+    index._retired = True
+    if index._users == 0:
+        index.close()
+
+
+def _acquire_index(index_dir: str) -> BitmapIndex:
+    global _current, _current_stat, _failed_stat
+    try:
+        stat_key = _pointer_stat_key(os.path.join(index_dir, POINTER_FILENAME))
+    except IndexUnavailable:
+        if _current is None:
+            raise
+        stat_key = _current_stat  # pointer vanished; keep serving what we have
+
+    with _lock:
+        if stat_key != _current_stat and stat_key != _failed_stat:
+            try:
+                # Build the new index fully before swapping it in
+                new = _load(index_dir)
+            except IndexUnavailable as exc:
+                _failed_stat = stat_key  # don't retry on every request
+                if _current is None:
+                    raise
+                logging.warning("Keeping previous bitmap index (%s): %s", _current.path, exc)
+            else:
+                old, _current, _current_stat = _current, new, stat_key
+                if old is not None:
+                    _retire(old)
+
+        if _current is None:
+            raise IndexUnavailable(f"Bitmap index in {index_dir} is unreadable; run the ETL again")
+        _current._users += 1
+        return _current
+
+
+@contextmanager
+def current_index(index_dir: str = BITMAP_INDEX_DIR):
+    """Yield the current index, keeping it open until the block exits."""
+    index = _acquire_index(index_dir)
+    try:
+        yield index
+    finally:
+        with _lock:
+            index._users -= 1
+            if index._retired and index._users == 0:
+                index.close()
+
+
+def intersect(include: dict, exclude: dict, limit: int, index_dir: str = BITMAP_INDEX_DIR) -> dict:
+    """Run a query and return plain values (no views into the mmap escape)."""
+    with current_index(index_dir) as index:
+        try:
+            result = index.query(include, exclude)
+            response = {
+                "count": count(result),
+                "user_ids": to_ids(result, limit),
+                "index_created_at": index.created_at,
+            }
+        except (struct.error, ValueError, TypeError) as exc:
+            raise IndexUnavailable(f"Bitmap index {index.path} is corrupt: {exc}") from exc
+        del result  # drop mmap views before the index may be closed
+    return response
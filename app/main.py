@@ -1,14 +1,20 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Request, Query
+from fastapi.responses import JSONResponse, PlainTextResponse
 from sqlalchemy.orm import Session
 import models
 import schemas 
 import crud
+import admission
+import bitmap_index
 from database import engine, get_db
 
 
 # Create database tables if they don't exist
 models.Base.metadata.create_all(bind=engine)
 
+# Make sure admission lanes can't admit more requests than the DB pool can serve
+admission.check_pool_capacity(engine)
+
 app = FastAPI(
     title="User Management API",
     description="CRUD operations for users, employment info, and bank info.",
@@ -16,6 +22,35 @@ app = FastAPI(
 )
 
 
+# -----------------------------------------------------------
+# ADMISSION CONTROL (per-lane limits, 503 + Retry-After when full)
+# -----------------------------------------------------------
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    lane = admission.classify(request)
+    if lane is None:
+        return await call_next(request)
+
+    try:
+        await lane.acquire()
+    except admission.Overloaded as exc:
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Server busy, please retry later"},
+            headers={"Retry-After": str(exc.retry_after)},
+        )
+
+    try:
+        return await call_next(request)
+    finally:
+        lane.release()
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def metrics():
+    return admission.render_metrics()
+
+
 
 # -----------------------------------------------------------
 # 1. CREATE USER (with employment + bank info)
@@ -46,6 +81,32 @@ def list_users(
     return users
 
 
+# -----------------------------------------------------------
+# 2b. INTERSECT USERS BY BANK / COMPANY / PINCODE (bitmap index)
+#     Declared before /users/{user_id} so "intersect" isn't parsed as an id.
+# -----------------------------------------------------------
+@app.get("/users/intersect", response_model=schemas.IntersectResponse)
+def intersect_users(
+    bank: list[str] = Query(default=[]),
+    company: list[str] = Query(default=[]),
+    pincode: list[str] = Query(default=[]),
+    not_bank: list[str] = Query(default=[]),
+    not_company: list[str] = Query(default=[]),
+    not_pincode: list[str] = Query(default=[]),
+    limit: int = Query(default=1000, ge=0, le=10_000),
+):
+    # Repeated values are ORed (bank=A&bank=B), different params are ANDed,
+    # not_* params exclude users. Keys match the ETL group keys exactly.
+    try:
+        return bitmap_index.intersect(
+            include={"bank": bank, "company": company, "pincode": pincode},
+            exclude={"bank": not_bank, "company": not_company, "pincode": not_pincode},
+            limit=limit,
+        )
+    except bitmap_index.IndexUnavailable as exc:
+        raise HTTPException(status_code=503, detail=str(exc))
+
+
 # -----------------------------------------------------------
 # 3. GET SINGLE USER
 # -----------------------------------------------------------
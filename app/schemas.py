@@ -126,3 +126,13 @@ class UserResponse(UserBase):
 
     class Config:
         orm_mode = True
+
+
+
+# -------------------------
+# Intersect (bitmap index) Schema
+# -------------------------
+class IntersectResponse(BaseModel):
+    count: int
+    user_ids: List[int]
+    index_created_at: str